@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi_mqtt.fastmqtt import FastMQTT
 from fastapi import FastAPI
 from fastapi_mqtt.config import MQQTConfig
@@ -9,20 +10,17 @@ fast_mqtt = FastMQTT(
 )
 
 
-app = FastAPI()
-
-
-@app.on_event("startup")
-async def startapp():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     await fast_mqtt.connection()
+    yield
+    await fast_mqtt.shutdown()
 
 
-@app.on_event("shutdown")
-async def shutdown():
-    await fast_mqtt.client.disconnect()
+app = FastAPI(lifespan=lifespan)
 
 @fast_mqtt.on_connect()
-def connect(client, flags, rc, properties):
+async def connect(client, flags, rc, properties):
     fast_mqtt.client.subscribe("/mqtt") #subscribing mqtt topic 
     print("Connected: ", client, flags, rc, properties)
 
@@ -42,6 +40,6 @@ def subscribe(client, mid, qos, properties):
 
 @app.get("/")
 async def func():
-    await fast_mqtt.publish("/mqtt", "Hello from Fastapi") #publishing mqtt topic 
+    fast_mqtt.publish("/mqtt", "Hello from Fastapi") #publishing mqtt topic 
 
     return {"result": True,"message":"Published" }
\ No newline at end of file
@@ -1,6 +1,7 @@
 
 from fastapi_mqtt.fastmqtt import FastMQTT
 from fastapi_mqtt.config import  MQQTConfig
+from fastapi_mqtt.errors import InflightLimitError
 
 
 __author__ = "Sabuhi Shukurov"
@@ -9,7 +10,7 @@ __email__ = 'sabuhi.shukurov@gmail.com'
 
 __credits__ = ["Sabuhi Shukurov","Hasan Aliyev", "Tural Muradov"]
 
-__version__ = "0.0.3"
+__version__ = "0.1.0"
 
 
-__all__ = ["FastMQTT", "MQQTConfig"]
\ No newline at end of file
+__all__ = ["FastMQTT", "MQQTConfig", "InflightLimitError"]
\ No newline at end of file
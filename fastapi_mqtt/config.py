@@ -1,4 +1,5 @@
-from pydantic import  BaseSettings as Settings
+from typing import Optional
+from pydantic import  BaseSettings as Settings, conint
 from gmqtt.mqtt.constants import MQTTv50
 
 
@@ -27,6 +28,16 @@ class MQQTConfig(Settings):
         If you want to change this behaviour pass reconnect_retries and reconnect_delay with its values. 
         For more info: # https://github.com/wialon/gmqtt#reconnects
 
+    enable_batching : if True, published messages are buffered and written to the broker connection at once 
+        every batch_interval_ms, one socket send for the whole batch instead of one per message. Defaults to False.
+    batch_interval_ms : Flush interval of the publish buffer in milliseconds, defaults to 10
+
+    max_inflight : Limit of QoS 1/2 messages waiting for broker acknowledgement, defaults to 1024. 
+        Once reached, publish raises InflightLimitError for QoS 1/2 messages (messages in the batch buffer count too) 
+        and publish_and_wait waits until the broker acknowledges earlier messages. The batch buffer is flushed early 
+        when it holds this many messages. QoS 0 messages never wait for acknowledgement, they are written to the 
+        connection right away or with the next batch flush. Must be positive, pass None to disable the limit.
+
     # Last three parameters is used after client disconnects abnormally 
     param :: will_message_topic : Topic of the payload
     param :: will_message_payload : The payload
@@ -43,6 +54,10 @@ class MQQTConfig(Settings):
     reconnect_retries: int  = None
     reconnect_delay: int = None
 
+    enable_batching: bool = False
+    batch_interval_ms: int = 10
+    max_inflight: Optional[conint(gt=0)] = 1024
+
     will_message_topic: str = None 
     will_message_payload: str = None 
     will_delay_interval: int = None
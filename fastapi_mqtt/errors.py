@@ -0,0 +1,4 @@
+class InflightLimitError(Exception):
+    '''
+        Raised by FastMQTT.publish when config.max_inflight QoS 1/2 messages are already waiting for broker acknowledgement.
+    '''
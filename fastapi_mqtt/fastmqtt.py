@@ -1,21 +1,140 @@
 import os
-import ssl
 import uuid
 import asyncio
-from ssl import SSLContext
+import itertools
+import collections
+import inspect
+import logging
+import struct
 from functools import partial
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Callable, Dict, Optional, Type, Union
+from ssl import SSLContext
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Type, Union
 from gmqtt import Message
 from gmqtt import Client as MQTTClient
-from gmqtt.mqtt.constants import MQTTv311,MQTTv50
+from gmqtt.mqtt.constants import MQTTv50
+from gmqtt.mqtt.package import PublishPacket
 from .config import MQQTConfig
-try:
-    from uvicorn.config import logger 
-    log_info = logger
-except:
-    import logging
-    log_info = logging.getLogger()
+from .errors import InflightLimitError
+
+# Same logger as uvicorn.config.logger, looked up by name so uvicorn is not imported here
+log_info = logging.getLogger("uvicorn.error")
+
+# Default client ids: random part is drawn once per import, pid keeps forked workers apart
+_CLIENT_ID_SEED = uuid.uuid4().hex[:12]
+_client_id_counter = itertools.count()
+
+class _Client(MQTTClient):
+    '''
+        gmqtt client which tracks acknowledgement of every QoS 1/2 message by its mid,
+        PUBACK for QoS 1 and PUBCOMP for QoS 2, and is able to send several messages with a single transport write.
+    '''
+    # Mirrors gmqtt 0.6.8 internals: Client.publish, the _remove_message_from_query and _handle_pubcomp_packet hooks,
+    # _connection._protocol.write_data, _persistent_storage and PublishPacket.build_package.
+    # Check them again before widening the gmqtt requirement in setup.py.
+
+    def __init__(self, client_id: str, **kwargs: Any) -> None:
+        super().__init__(client_id, **kwargs)
+        self._puback_waiters: Dict[int, asyncio.Future] = {}
+        self._pubcomp_waiters: Dict[int, asyncio.Future] = {}
+        # callers of wait_for_acknowledgement, each acknowledgement wakes the first one
+        self._acknowledgement_waiters: Deque[asyncio.Future] = collections.deque()
+
+    def publish(self, message_or_topic: Any, payload: Any = None, qos: int = 0, retain: bool = False, **kwargs) -> Optional[asyncio.Future]:
+        '''
+            Same as gmqtt.Client.publish, but returns a Future resolved once the broker acknowledged
+            the message, or None for qos 0.
+        '''
+        if isinstance(message_or_topic, Message):
+            message = message_or_topic
+        else:
+            message = Message(message_or_topic, payload, qos=qos, retain=retain, **kwargs)
+
+        mid, package = self._connection.publish(message)
+        return self.__track(message, mid, package)
+
+    def publish_many(self, messages: List[Message]) -> None:
+        protocol = self._connection._protocol
+        built = []
+        try:
+            for message in messages:
+                built.append((message, *PublishPacket.build_package(message, protocol)))
+            protocol.write_data(b"".join(package for _, _, package in built))
+        except Exception:
+            # nothing was sent, give the message ids back so a retry does not leak them
+            for message, mid, _ in built:
+                if message.qos:
+                    PublishPacket.id_generator.free_id(mid)
+            raise
+
+        for message, mid, package in built:
+            self.__track(message, mid, package)
+
+    @property
+    def unacknowledged(self) -> int:
+        return len(self._puback_waiters) + len(self._pubcomp_waiters)
+
+    async def wait_for_acknowledgement(self) -> None:
+        '''
+            Waits until the broker acknowledged one more message. Every acknowledgement wakes exactly one waiter.
+        '''
+        waiter = asyncio.get_running_loop().create_future()
+        self._acknowledgement_waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self._acknowledgement_waiters.remove(waiter)
+            else:
+                # woken up but cancelled before running, hand the wakeup to the next waiter
+                self.__wake_next()
+            raise
+
+    def cancel_acknowledgements(self) -> None:
+        for waiters in (self._puback_waiters, self._pubcomp_waiters):
+            for ack in waiters.values():
+                ack.cancel()
+            waiters.clear()
+
+        while self._acknowledgement_waiters:
+            self.__wake_next()
+
+    def __track(self, message: Message, mid: int, package: bytes) -> Optional[asyncio.Future]:
+        if not message.qos:
+            return None
+
+        self._persistent_storage.push_message_nowait(mid, package)
+        waiters = self._puback_waiters if message.qos == 1 else self._pubcomp_waiters
+        # gmqtt frees the mid of a QoS 2 message on PUBREC, the broker has the message by then
+        self.__resolve(waiters, mid)
+        ack = waiters[mid] = asyncio.get_running_loop().create_future()
+        return ack
+
+    def _remove_message_from_query(self, mid: int) -> None:
+        # called by gmqtt on PUBACK and on PUBREC
+        super()._remove_message_from_query(mid)
+        self.__resolve(self._puback_waiters, mid)
+
+    def _handle_pubcomp_packet(self, cmd: int, packet: bytes) -> None:
+        super()._handle_pubcomp_packet(cmd, packet)
+        (mid,) = struct.unpack("!H", packet[:2])
+        self.__resolve(self._pubcomp_waiters, mid)
+
+    def __resolve(self, waiters: Dict[int, asyncio.Future], mid: int) -> None:
+        ack = waiters.pop(mid, None)
+        if ack is None:
+            return None
+
+        if not ack.done():
+            ack.set_result(None)
+        self.__wake_next()
+
+    def __wake_next(self) -> None:
+        while self._acknowledgement_waiters:
+            waiter = self._acknowledgement_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return None
+
 
 class FastMQTT:
     '''
@@ -43,6 +162,8 @@ class FastMQTT:
         type  :: optimistic_acknowledgement: bool
         ```
     '''
+    __slots__ = ("client", "config", "_connect_args", "_reconnect_cfg", "_pending", "_batch_task", "_handler_tasks")
+
     def __init__(
         self,
         config: MQQTConfig,  
@@ -53,34 +174,46 @@ class FastMQTT:
         **kwargs: Any
     ) -> None:
 
-        
+        if not client_id: client_id = f"fastmqtt-{_CLIENT_ID_SEED}-{os.getpid()}-{next(_client_id_counter)}"
 
-        if not client_id: client_id = uuid.uuid4().hex
-
-        self.client: MQTTClient = MQTTClient(client_id)
-        self.config: Dict[Any,Any] = config
+        self.client: _Client = _Client(client_id)
+        self.config: MQQTConfig = config
 
         self.client._clean_session = clean_session
         self.client._username: Optional[str] = config.username or None
         self.client._password: Optional[str] = config.password or None
-        self.client._host: str =  config.host
-        self.client._port: int =  config.port
-        self.client._keepalive: int = config.keepalive
-        self.client._ssl: Union[bool,SSLContext]  =  config.ssl
         self.client.optimistic_acknowledgement: bool = optimistic_acknowledgement
         self.client._connect_properties: Any = kwargs
-        self.executor = ThreadPoolExecutor()
-        self.loop = asyncio.get_event_loop()
-        
-        log_info = logger
 
-        if self.config.will_message_topic and self.config.will_message_payload and self.config.will_delay_interval:
+        # gmqtt stores host, port, ssl and keepalive on the client itself when connecting
+        self._connect_args: Tuple[str, int, Union[bool, SSLContext], int, int] = (
+            config.host, config.port, config.ssl, config.keepalive, config.version or MQTTv50
+        )
+        # By default, connected MQTT client will always try to reconnect in case of lost connections.
+        # Only the reconnect options given in config override gmqtt defaults.
+        # For more info: https://github.com/wialon/gmqtt#reconnects
+        self._reconnect_cfg: Dict[str, int] = {
+            key: value for key, value in (
+                ("reconnect_retries", config.reconnect_retries),
+                ("reconnect_delay", config.reconnect_delay),
+            ) if value
+        }
+
+        self._pending: List[Message] = []
+        self._batch_task: Optional[asyncio.Future] = None
+        # running coroutine handlers, referenced here so they are not garbage collected while running
+        self._handler_tasks: Set[asyncio.Future] = set()
+
+        if config.will_message_topic and config.will_message_payload and config.will_delay_interval:
             self.client._will_message = Message(
-                self.config.will_message_topic, 
-                self.config.will_message_payload,
-                self.config.will_delay_interval
+                config.will_message_topic, 
+                config.will_message_payload,
+                config.will_delay_interval
+            )
+            log_info.debug(
+                "topic -> %s \n payload -> %s \n will_delay_interval -> %s",
+                config.will_message_topic, config.will_message_payload, config.will_delay_interval
             )
-            log_info.debug(f"topic -> {self.config.will_message_topic} \n payload -> {self.config.will_message_payload} \n will_delay_interval -> {self.config.will_delay_interval}")
             log_info.info("WILL MESSAGE INITIALIZED")
 
 
@@ -90,44 +223,28 @@ class FastMQTT:
             self.client.set_auth_credentials(self.client._username, self.client._password)
             log_info.info("user is authenticated")
 
-        await self.__set_connetion_config()
+        if self._reconnect_cfg:
+            self.client.set_config(self._reconnect_cfg)
 
-        version = self.config.version or MQTTv50
-        log_info.warning(f"Used broker version is {version}")
+        log_info.warning(f"Used broker version is {self._connect_args[-1]}")
 
-        await self.client.connect(self.client._host,self.client._port,self.client._ssl,self.client._keepalive,version)
+        await self.client.connect(*self._connect_args)
         log_info.info("connected to broker..")
 
-    async def __set_connetion_config(self) -> None:
-        '''
-            By default, connected MQTT client will always try to reconnect in case of lost connections. 
-            Number of reconnect attempts is unlimited. If you want to change this behaviour ass reconnect_retries and reconnect_delay with its values. 
-            For more info: # https://github.com/wialon/gmqtt#reconnects
-        '''
-       
-        if self.config.reconnect_retries:
-            self.client.set_config(reconnect_retries=self.config.reconnect_retries)
-           
-        if self.config.reconnect_delay:
-            self.client.set_config(reconnect_delay=self.config.reconnect_delay)
-
-    def on_message(self):
+    def on_message(self, handler: Optional[Callable] = None) -> Callable:
         """
         Decarator method used to subscirbe messages from all topics.
+        Can be used both as @on_message() and @on_message.
         """
-        
-        def message_handler(handler: Callable) -> Callable:
-            log_info.info("on_message handler accepted")
-            self.client.on_message = handler
-            
-            return handler
-
-        return message_handler
+        return self.__register_handler("on_message", handler)
 
 
-    async def publish(self, message_or_topic: str, payload: Any = None, qos: int = 0, retain: bool = False, **kwargs):
+    def publish(self, message_or_topic: str, payload: Any = None, qos: int = 0, retain: bool = False, **kwargs) -> None:
         '''
-            publish method
+            publish method, returns as soon as the message is handed to gmqtt (no await needed)
+
+            Must be called from the event loop thread, e.g. in `async def` endpoints. 
+            Plain `def` endpoints run in a threadpool and raise RuntimeError here.
         
             param :: message_or_topic : topic name
             type  :: message_or_topic:  str
@@ -140,11 +257,120 @@ class FastMQTT:
             
             param :: retain : 
             type  :: retain:  
+
+            When batching is enabled in config the message is buffered and written to the broker
+            connection together with other messages published within batch_interval_ms.
+
+            Raises ConnectionError before connection() was awaited, the message is not queued then.
+            Raises InflightLimitError for a qos 1/2 message when config.max_inflight messages already wait 
+            for acknowledgement or sit in the batch buffer.
+        '''
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            raise RuntimeError(
+                "FastMQTT.publish must be called from the event loop thread, use it in `async def` endpoints"
+            ) from None
+
+        log_info.debug("publish %s", message_or_topic)
+        self.__check_connection()
+        if isinstance(message_or_topic, Message):
+            message = message_or_topic
+        else:
+            message = Message(message_or_topic, payload, qos=qos, retain=retain, **kwargs)
+
+        max_inflight = self.config.max_inflight
+        if message.qos and max_inflight is not None and self.client.unacknowledged + len(self._pending) >= max_inflight:
+            raise InflightLimitError(f"{max_inflight} messages are already waiting for broker acknowledgement")
+
+        if self.config.enable_batching:
+            if max_inflight is not None and len(self._pending) >= max_inflight:
+                # buffer is full, the message is not queued if it cannot be emptied
+                self.__flush_pending()
+
+            self._pending.append(message)
+            if self._batch_task is None or self._batch_task.done():
+                self._batch_task = asyncio.ensure_future(self.__flush_later())
+            return None
+
+        self.client.publish(message)
+        return None
+
+    async def publish_and_wait(self, message_or_topic: str, payload: Any = None, qos: int = 1, retain: bool = False, **kwargs) -> None:
+        '''
+            publish method which waits for delivery acknowledgement, parameters are the same as for publish
+
+            The message is sent immediately, messages still in the batch buffer are flushed before it
+            to keep publish order. For qos 1 returns once the broker sent PUBACK,
+            for qos 2 once it sent PUBCOMP for this message. Wrap the call in asyncio.wait_for to limit waiting time.
+
+            When config.max_inflight messages already wait for acknowledgement, the message is sent only after 
+            the broker acknowledged earlier ones, so a fast publisher is slowed down to the pace of the broker.
         '''
 
-        func = partial(self.client.publish, message_or_topic, payload=payload, qos=qos, retain=retain, **kwargs)
-        log_info.info("publish")
-        return await loop.run_in_executor(self.executor, func)
+        log_info.debug("publish_and_wait %s", message_or_topic)
+        self.__check_connection()
+        if isinstance(message_or_topic, Message):
+            message = message_or_topic
+        else:
+            message = Message(message_or_topic, payload, qos=qos, retain=retain, **kwargs)
+
+        max_inflight = self.config.max_inflight
+        while message.qos and max_inflight is not None and self.client.unacknowledged >= max_inflight:
+            await self.client.wait_for_acknowledgement()
+
+        self.__flush_pending()
+        ack = self.client.publish(message)
+        if ack is not None:
+            await ack
+
+    def __check_connection(self) -> None:
+        # gmqtt creates the connection in connect() and keeps it afterwards, reconnects reuse the client state
+        if self.client._connection is None:
+            raise ConnectionError("FastMQTT is not connected to broker, await connection() before publishing")
+
+    async def __flush_later(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.batch_interval_ms / 1000)
+            try:
+                self.__flush_pending()
+                return None
+            except Exception:
+                log_info.exception("batched publish failed, %s messages kept for the next flush", len(self._pending))
+
+    def __flush_pending(self) -> None:
+        '''
+            Publishes all buffered messages with a single transport write.
+            If that fails the messages are put back in front of the buffer and the error is raised.
+        '''
+        if not self._pending:
+            return None
+
+        batch, self._pending = self._pending, []
+        try:
+            self.client.publish_many(batch)
+        except Exception:
+            self._pending[:0] = batch
+            raise
+
+    async def shutdown(self) -> None:
+        '''
+            Publishes messages still waiting in the batch buffer and disconnects from broker.
+            Pending publish_and_wait calls are cancelled.
+        '''
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            self._batch_task = None
+
+        try:
+            self.__flush_pending()
+        except Exception:
+            log_info.exception("%s buffered messages were not published", len(self._pending))
+
+        await self.client.disconnect()
+        self.client.cancel_acknowledgements()
+        log_info.info("disconnected from broker..")
 
     async def unsubscribe(self, topic: str, **kwargs):
 
@@ -155,46 +381,52 @@ class FastMQTT:
             type  :: str:  
         '''
 
-        func = partial(self.client.unsubscribe, topic, **kwargs)
-        log_info.info("unsubscribe")
-        return await self.loop.run_in_executor(self.executor, func)
+        log_info.debug("unsubscribe %s", topic)
+        return self.client.unsubscribe(topic, **kwargs)
     
-    def on_connect(self):
+    def on_connect(self, handler: Optional[Callable] = None) -> Callable:
         """
         Decarator method used to handle connection to MQTT.
         """
-        def connect_handler(handler: Callable) -> Callable:
-            log_info.info("handler accepted")
-            self.client.on_connect = handler
-                
-            return handler
-
-        return connect_handler
+        return self.__register_handler("on_connect", handler)
     
     
-    def on_subscribe(self):
+    def on_subscribe(self, handler: Optional[Callable] = None) -> Callable:
         """
         Decarator method used to obtain subscibred topics and properties.
         """
-
-        def subscribe_handler(handler: Callable):
-            log_info.info("on_subscribe handler accepted")
-            self.client.on_subscribe = handler
-            return handler
-
-        return subscribe_handler
+        return self.__register_handler("on_subscribe", handler)
 
      
-    def on_disconnect(self):
+    def on_disconnect(self, handler: Optional[Callable] = None) -> Callable:
         """
         Decarator method used wrap disconnet callback.
-
         """
-        
-        def disconnect_handler(handler: Callable) -> Callable:
-            log_info.info("on_disconnect handler accepted")
-            self.client.on_disconnect = handler
+        return self.__register_handler("on_disconnect", handler)
+
+    def __register_handler(self, event: str, handler: Optional[Callable]) -> Callable:
+        '''
+            Sets handler as gmqtt client callback for the event.
+            Without handler returns the decorator to be applied, which allows calling the on_* methods with or without parentheses.
+
+            gmqtt awaits coroutine on_message handlers itself but calls the other callbacks synchronously,
+            so coroutine handlers for those are scheduled on the event loop by __dispatch.
+        '''
+        if handler is None:
+            return partial(self.__register_handler, event)
+
+        if event != "on_message" and inspect.iscoroutinefunction(handler):
+            setattr(self.client, event, partial(self.__dispatch, handler))
+        else:
+            setattr(self.client, event, handler)
+        return handler
 
-            return handler
+    def __dispatch(self, handler: Callable, *args: Any, **kwargs: Any) -> None:
+        task = asyncio.ensure_future(handler(*args, **kwargs))
+        self._handler_tasks.add(task)
+        task.add_done_callback(partial(self.__handler_done, handler))
 
-        return disconnect_handler
\ No newline at end of file
+    def __handler_done(self, handler: Callable, task: asyncio.Future) -> None:
+        self._handler_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log_info.error("handler %s raised an exception", handler.__qualname__, exc_info=task.exception())
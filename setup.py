@@ -26,12 +26,12 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     license='MIT',
     url="https://github.com/sabuhish/fastapi-mqtt",
-    install_requires=["gmqtt>=0.6.8","uvicorn>=0.12.2", 'pydantic>=1.7.2',"fastapi>=0.61.2"],
+    install_requires=["gmqtt>=0.6.8,<0.7","uvicorn>=0.12.2", 'pydantic>=1.7.2',"fastapi>=0.61.2"],
     platforms=['any'],
     packages=setuptools.find_packages(),
     download_url="https://github.com/sabuhish/fastapi-mqtt",
     classifiers=CLASSIFIERS,
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     project_urls={  
         'Bug Reports': 'https://github.com/sabuhish/fastapi-mqtt/issues',
         'Say Thanks!': 'https://github.com/sabuhish/fastapi-mqtt/graphs/contributors',
@@ -0,0 +1,188 @@
+import asyncio
+import struct
+
+import pytest
+from gmqtt import Message
+from gmqtt.mqtt.constants import MQTTv50
+from gmqtt.mqtt.package import PublishPacket
+
+from fastapi_mqtt import FastMQTT, InflightLimitError, MQQTConfig
+
+
+class FakeProtocol:
+    '''
+        Stands in for gmqtt's MQTTProtocol, records every transport write.
+    '''
+    proto_ver = MQTTv50
+
+    def __init__(self):
+        self.writes = []
+
+    def write_data(self, data):
+        self.writes.append(bytes(data))
+
+
+class FakeConnection:
+    '''
+        Stands in for gmqtt's MQTTConnection on top of FakeProtocol.
+    '''
+
+    def __init__(self):
+        self._protocol = FakeProtocol()
+
+    def publish(self, message):
+        mid, package = PublishPacket.build_package(message, self._protocol)
+        self._protocol.write_data(package)
+        return mid, package
+
+    def send_command_with_mid(self, cmd, mid, dup, reason_code=0):
+        pass
+
+
+def run(test, **config):
+    async def main():
+        fast_mqtt = FastMQTT(MQQTConfig(**config))
+        fast_mqtt.client._connection = FakeConnection()
+        try:
+            await test(fast_mqtt)
+        finally:
+            fast_mqtt.client._resend_task.cancel()
+
+    asyncio.run(main())
+
+
+def ack(fast_mqtt, packet_type, mid):
+    handler = getattr(fast_mqtt.client, f"_handle_{packet_type}_packet")
+    handler(0, struct.pack("!H", mid))
+
+
+def test_publish_does_not_leave_tasks_behind():
+    async def test(fast_mqtt):
+        await asyncio.sleep(0)
+        tasks_before = len(asyncio.all_tasks())
+        for i in range(10000):
+            fast_mqtt.publish("/mqtt", i)
+        await asyncio.sleep(0)
+
+        assert len(asyncio.all_tasks()) == tasks_before
+
+    run(test)
+
+
+def test_batched_publish_does_not_leave_tasks_behind():
+    async def test(fast_mqtt):
+        await asyncio.sleep(0)
+        tasks_before = len(asyncio.all_tasks())
+        for i in range(10000):
+            fast_mqtt.publish("/mqtt", i)
+        await asyncio.sleep(0.05)
+
+        assert len(asyncio.all_tasks()) == tasks_before
+        assert not fast_mqtt._pending
+
+    run(test, enable_batching=True, max_inflight=None)
+
+
+def test_batch_is_flushed_with_single_write():
+    async def test(fast_mqtt):
+        protocol = fast_mqtt.client._connection._protocol
+        for i in range(5):
+            fast_mqtt.publish("/mqtt", i)
+        assert protocol.writes == []
+
+        await asyncio.sleep(0.05)
+
+        expected = b"".join(PublishPacket.build_package(Message("/mqtt", i), protocol)[1] for i in range(5))
+        assert protocol.writes == [expected]
+
+    run(test, enable_batching=True)
+
+
+def test_publish_before_connection_is_refused_without_queueing():
+    async def test(fast_mqtt):
+        fast_mqtt.client._connection = None
+        with pytest.raises(ConnectionError):
+            fast_mqtt.publish("/mqtt", 1)
+
+        assert fast_mqtt._pending == []
+
+    run(test, enable_batching=True)
+
+
+def test_qos1_is_resolved_by_puback():
+    async def test(fast_mqtt):
+        waiting = asyncio.ensure_future(fast_mqtt.publish_and_wait("/mqtt", 1, qos=1))
+        await asyncio.sleep(0)
+        (mid,) = fast_mqtt.client._puback_waiters
+        assert not waiting.done()
+
+        ack(fast_mqtt, "puback", mid)
+        await asyncio.wait_for(waiting, 1)
+
+        assert fast_mqtt.client.unacknowledged == 0
+
+    run(test)
+
+
+def test_qos2_is_resolved_by_pubcomp_not_pubrec():
+    async def test(fast_mqtt):
+        waiting = asyncio.ensure_future(fast_mqtt.publish_and_wait("/mqtt", 1, qos=2))
+        await asyncio.sleep(0)
+        (mid,) = fast_mqtt.client._pubcomp_waiters
+
+        ack(fast_mqtt, "pubrec", mid)
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        ack(fast_mqtt, "pubcomp", mid)
+        await asyncio.wait_for(waiting, 1)
+
+    run(test)
+
+
+def test_publish_and_wait_ignores_other_messages_in_flight():
+    async def test(fast_mqtt):
+        fast_mqtt.publish("/mqtt", "other", qos=1)
+        waiting = asyncio.ensure_future(fast_mqtt.publish_and_wait("/mqtt", "own", qos=1))
+        await asyncio.sleep(0)
+        other_mid, own_mid = fast_mqtt.client._puback_waiters
+
+        ack(fast_mqtt, "puback", own_mid)
+        await asyncio.wait_for(waiting, 1)
+
+        assert list(fast_mqtt.client._puback_waiters) == [other_mid]
+
+    run(test)
+
+
+def test_inflight_limit():
+    async def test(fast_mqtt):
+        fast_mqtt.publish("/mqtt", 1, qos=1)
+        fast_mqtt.publish("/mqtt", 2, qos=1)
+        with pytest.raises(InflightLimitError):
+            fast_mqtt.publish("/mqtt", 3, qos=1)
+
+        # qos 0 messages never wait for acknowledgement
+        fast_mqtt.publish("/mqtt", 4)
+
+        waiting = asyncio.ensure_future(fast_mqtt.publish_and_wait("/mqtt", 5, qos=1))
+        await asyncio.sleep(0)
+        assert fast_mqtt.client.unacknowledged == 2
+
+        ack(fast_mqtt, "puback", next(iter(fast_mqtt.client._puback_waiters)))
+        await asyncio.sleep(0)
+        assert fast_mqtt.client.unacknowledged == 2
+        assert not waiting.done()
+
+        for mid in list(fast_mqtt.client._puback_waiters):
+            ack(fast_mqtt, "puback", mid)
+        await asyncio.wait_for(waiting, 1)
+
+    run(test, max_inflight=2)
+
+
+def test_max_inflight_must_be_positive():
+    with pytest.raises(ValueError):
+        MQQTConfig(max_inflight=0)
+
+    assert MQQTConfig(max_inflight=None).max_inflight is None